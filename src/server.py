@@ -2,24 +2,103 @@ import socket
 import threading
 import argparse
 import logging
+import queue
 from dataclasses import dataclass, field
 import time
 from typing import Dict, List, Tuple
 from utils.format_log import setup_logging
-from utils.utils import encode_resp, decode_resp
+from utils.utils import encode_resp, decode_resp, decode_resp_at, decode_rdb_at, encode_error, sendmsg_all, IncompleteRESPError
 
 setup_logging(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Replies of a read batch larger than this are written with scatter-gather instead of being joined first
+WRITEV_THRESHOLD = 16 * 1024
+# Size of a single read from a client socket
+READ_CHUNK_SIZE = 64 * 1024
+# Number of arguments of each command including its name, negative values are a minimum like in Redis
+COMMAND_ARITY = {
+    'ping': -1, 'echo': 2, 'set': -3, 'get': 2, 'del': 2, 'exists': 2, 'info': -1,
+    'replconf': -2, 'psync': -2, 'client': -2, 'shutdown': -1, 'unknown': -1,
+    'multi': 1, 'exec': 1, 'discard': 1, 'watch': -2, 'unwatch': 1,
+}
+# Commands that never touch the keyspace and run without taking the keyspace lock
+LOCK_FREE_COMMANDS = {'ping', 'echo', 'info', 'client'}
+
+@dataclass
+class ClientState:
+    '''Per-connection state of a client, holding its queued transaction, watched keys, pending replies and traffic counters.'''
+
+    connection: socket.socket
+    address: Tuple[str, int]
+    id: int = 0
+    in_multi: bool = False
+    multi_error: bool = False
+    queued: List[list] = field(default_factory=list)
+    watched: Dict[str, int] = field(default_factory=dict)
+    replication_backlog: List[list] = None
+    query_buffer: bytearray = field(default_factory=bytearray)
+    query_needed: int = 0
+    expecting_rdb: bool = False
+    output_buffer: List[bytes] = field(default_factory=list)
+    output_size: int = 0
+    replication_queue: queue.Queue = None
+    replication_queued: int = 0
+    replication_sent: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    commands_processed: int = 0
+    last_command: str = "NULL"
+    created_at: float = field(default_factory=time.time)
+    last_interaction: float = field(default_factory=time.time)
+    killed: bool = False
+
+    @property
+    def addr(self):
+        '''The address of the client in host:port form.'''
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def add_reply(self, response):
+        '''Buffers a reply until the end of the current read batch.'''
+        self.output_buffer.append(response)
+        self.output_size += len(response)
+
+    def flush(self):
+        '''Writes all buffered replies to the connection at once.'''
+        if not self.output_buffer:
+            return
+
+        if len(self.output_buffer) > 1 and self.output_size >= WRITEV_THRESHOLD and hasattr(self.connection, "sendmsg"):
+            sendmsg_all(self.connection, self.output_buffer)
+        else:
+            self.connection.sendall(b''.join(self.output_buffer))
+
+        self.bytes_out += self.output_size
+        self.output_buffer.clear()
+        self.output_size = 0
+
+    def reset_transaction(self):
+        '''Leaves MULTI, dropping the queued commands.'''
+        self.in_multi = False
+        self.multi_error = False
+        self.queued.clear()
+        self.replication_backlog = None
+
 @dataclass
 class RedisServer:
     '''A basic implementation of a Redis-like server supporting basic commands and master-slave replication.'''
     
     CACHE: Dict[str, str] = field(default_factory=dict)
     TTL: Dict[str, int] = field(default_factory=dict)
+    # Versions are only tracked for keys that at least one client is watching
+    VERSIONS: Dict[str, int] = field(default_factory=dict)
+    WATCHERS: Dict[str, int] = field(default_factory=dict)
+    lock: threading.RLock = field(default_factory=threading.RLock)
     PORT: int = 6379
     shutdown_event: threading.Event = threading.Event()
+    server_socket: socket.socket = None
     SLAVES: List[socket.socket]= field(default_factory=list)
+    REPLICAS: Dict[socket.socket, ClientState] = field(default_factory=dict)
     
     role: str = "master"
     master_replid: str = "8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb"
@@ -28,162 +107,170 @@ class RedisServer:
     master_port: int = 6379
     master_socket: socket.socket = None
 
+    CLIENTS: Dict[int, ClientState] = field(default_factory=dict)
+    clients_lock: threading.Lock = field(default_factory=threading.Lock)
+    next_client_id: int = 1
+    maxclients: int = 10000
+    timeout: int = 0
+    tcp_nodelay: bool = True
+    tcp_keepalive: int = 300
+    client_query_buffer_limit: int = 1024 * 1024 * 1024
+    replica_output_buffer_limit: int = 256 * 1024 * 1024
+
     def start_server(self):
         '''Starts the slave server, listening for incoming connections and performing the initial handshake with the master server.'''
         self.shutdown_event.clear()
-        server_socket = socket.create_server(("0.0.0.0", self.PORT), reuse_port=True)
+        self.server_socket = server_socket = socket.create_server(("0.0.0.0", self.PORT), reuse_port=True)
         logger.info(f"{self.role.capitalize()} Server listening on port {self.PORT}")
 
         if self.role == "slave":
             threading.Thread(target=self.handshake, daemon=True).start()
 
 
+        last_reap = time.time()
         while not self.shutdown_event.is_set():
+            # The accept timeout doubles as the tick of the idle client reaper
+            if self.timeout and time.time() - last_reap >= 1:
+                self.reap_idle_clients()
+                last_reap = time.time()
+
             try:
                 server_socket.settimeout(1)
                 connection, address = server_socket.accept()
-                logger.info(f"Accepted connection from {address}")
-                threading.Thread(target=self.handle_client, args=(connection, address), daemon=True).start()
             except socket.timeout:
                 continue
+            except OSError:
+                # The listening socket was closed by SHUTDOWN
+                break
+
+            if len(self.CLIENTS) >= self.maxclients:
+                logger.warning(f"Rejecting connection from {address}, max number of clients reached")
+                self.reject_client(connection)
+                continue
+
+            logger.info(f"Accepted connection from {address}")
+            self.configure_socket(connection)
+            client = self.register_client(connection, address)
+            threading.Thread(target=self.handle_client, args=(connection, address, client), daemon=True).start()
 
     def shutdown(self):
         self.shutdown_event.set()
+        # Stop listening right away instead of at the next accept timeout
+        if self.server_socket is not None:
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
         logger.info("Server shutdown initiated")
 
-    def handle_client(self, connection, address):
+    def configure_socket(self, connection):
+        '''Applies the TCP_NODELAY and keepalive options to a connection.'''
+        if self.tcp_nodelay:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if self.tcp_keepalive > 0:
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Fine grained keepalive timing is only available on some platforms
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.tcp_keepalive)
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, self.tcp_keepalive // 3))
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+    def reject_client(self, connection):
+        '''Refuses a connection over the maxclients limit without starting a thread for it.'''
+        try:
+            connection.sendall(encode_error("ERR max number of clients reached"))
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+    def register_client(self, connection, address):
+        '''Creates the state of a new connection and adds it to the list of connected clients.'''
+        with self.clients_lock:
+            client = ClientState(connection=connection, address=address, id=self.next_client_id)
+            self.next_client_id += 1
+            self.CLIENTS[client.id] = client
+        return client
+
+    def unregister_client(self, client):
+        '''Removes a closed connection from the list of connected clients.'''
+        with self.clients_lock:
+            self.CLIENTS.pop(client.id, None)
+
+    def kill_client(self, client, current=None):
+        '''Closes the connection of a client. The calling client is only marked and closed once its replies are written.'''
+        client.killed = True
+        if client is not current:
+            try:
+                client.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def is_replication_link(self, client):
+        '''Checks whether a client is the connection to our master or to one of our slaves.'''
+        return client.connection is self.master_socket or client.connection in self.SLAVES
+
+    def reap_idle_clients(self):
+        '''Closes the client connections that have been idle for longer than the configured timeout.'''
+        now = time.time()
+        with self.clients_lock:
+            clients = list(self.CLIENTS.values())
+
+        for client in clients:
+            if not self.is_replication_link(client) and now - client.last_interaction > self.timeout:
+                logger.info(f"Closing idle client {client.addr}")
+                self.kill_client(client)
+
+    def handle_client(self, connection, address, client=None):
         '''Handles communication with a connected client, processing commands and returning appropriate responses.'''
-            
+
+        if client is None:
+            client = self.register_client(connection, address)
         try:
-            while not self.shutdown_event.is_set():
-                data = connection.recv(4096)
+            while not self.shutdown_event.is_set() and not client.killed:
+                data = connection.recv(READ_CHUNK_SIZE)
 
                 if not data:
                     break
+
+                client.bytes_in += len(data)
+                client.last_interaction = time.time()
                 
                 logger.debug(f"{self.role.capitalize()} Received data: {data}")
                 
-                all_commands = []
-                # Split multiple lists into individual commands
-                if data.count(b'*') > 1:
-                    commands = data.split(b'*')
-                    for cmd in commands:
-                        if not cmd or not isinstance(cmd, list):
-                            continue
-                        tmp, _ = decode_resp(b'*' + cmd)
-                        all_commands.append(tmp)
-                else:
-                    tmp, _ = decode_resp(data)
-                    all_commands.append(tmp)
+                client.query_buffer += data
+                all_commands = self.parse_query_buffer(client)
+                if max(len(client.query_buffer), client.query_needed) > self.client_query_buffer_limit:
+                    logger.warning(f"Closing client {client.addr}, query buffer limit reached")
+                    break
 
                 logger.debug(f"Decoded commands: {all_commands}")
                 for command in all_commands:
-                    if not command:
-                        continue
-                    for i in range(len(command)):
-                        if isinstance(command[i], bytes):
-                            command[i] = command[i].decode()
-                    logger.info(f"Received command: {command}")
-                    response = None
-                    cmd_type = command[0].lower() if type(command[0]) is str else command[0]
-
-                    if cmd_type == 'ping':
-                        logger.debug("Sending PONG")
-                        response = encode_resp('PONG')
-                    elif cmd_type == 'echo':
-                        logger.debug(f"Echoing back {command[1]}")
-                        response = encode_resp(command[1].encode())
-                    elif cmd_type == 'set':
-                        key: str = str(command[1])
-                        value: str = str(command[2])
-                        logger.debug(f"Setting key {key} to value {value}")
-                        self.CACHE[key] = value
-
-                        if len(command) > 3 and command[3].lower() == 'px':
-                            logger.debug(f"Setting TTL for key {key} to {command[4]} milliseconds")
-                            self.TTL[key] = time.time() + int(command[4]) / 1000
-
-                        if connection is not self.master_socket:
-                            response = encode_resp('OK')
-                        
-                        if self.role == "master":
-                            for socket in self.SLAVES:
-                                logger.debug(f"Sending {command} to slave at {socket.getpeername()}")
-                                try:
-                                    socket.sendall(encode_resp(command))
-                                except Exception as e:
-                                    logger.error(f"Error sending to slave: {e}")
-                                    socket.close()
-                                    self.SLAVES.remove(socket)
-                    elif cmd_type == 'del':
-                        key: str = str(command[1])
-                        
-                        if key in self.CACHE:
-                            del self.CACHE[key]
-        
-                            if key in self.TTL:    
-                                del self.TTL[key]
-
-                            response = encode_resp(1)
-                            logger.debug(f"Deleting key {key}")
-                        else:
-                            logger.debug(f"No key {key} to delete")
-                            response = encode_resp(0)
-                    elif cmd_type == 'get':
-                        logger.debug(f"Getting key {command[1]}")
-                        if command[1] in self.TTL and self.TTL[command[1]] < time.time():
-                            del self.CACHE[command[1]]
-                            del self.TTL[command[1]]
-                        value = self.CACHE.get(command[1], None)
-                        logger.debug(f"Value for key {command[1]} is {value}")
-                        response = encode_resp(value.encode() if value is not None else None)
-                    elif cmd_type == 'info':
-                        logger.debug(f"Sending server info role:{self.role}, connected_slaves:{len(self.SLAVES)}, master_replid:{self.master_replid}, master_repl_offset:{self.master_repl_offset}")
-                        response = encode_resp(f"role:{self.role}, connected_slaves:{len(self.SLAVES)}, master_replid:{self.master_replid}, master_repl_offset:{self.master_repl_offset}")
-                    elif cmd_type == 'replconf':
-                        if command[1].lower() == "listening-port":
-                            logger.debug(f"Received REPLCONF listening-port {command[2]}")
-                            self.SLAVES.append(connection)
-                            logger.debug(f"Added slave {address} to list of slaves {self.SLAVES}")
-                            response = encode_resp('OK')
-                        elif command[1].lower() == "capa":
-                            response = encode_resp('OK')
-                        elif command[1].lower() == "getack":
-                            logger.debug(f"Received ACK from slave {address}")
-                            response = encode_resp(['REPLECONF','ACK',0])
-                        else:
-                            logger.debug(f"Received unknown REPLCONF command: {command}")
-                            response = encode_resp('OK')
-                    elif cmd_type == 'psync':
-                        if command[1] == "?":
-                            response = encode_resp(f"FULLRESYNC {self.master_replid} {self.master_repl_offset}")
-                            rdb_hex = "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e3bfec0ff5aa2"
-                            rdb_content = bytes.fromhex(rdb_hex)
-                            length = len(rdb_content)
-                            header = f"${length}\r\n".encode()
-                            logger.debug("Sending RDP file to SLAVE")
-                            response += header + rdb_content
-                    elif cmd_type == 'fullresync':
-                        logger.debug("Receiving RDB file from master")
-                    elif cmd_type == 'exists':
-                        key: str = str(command[1])
-                        logger.debug(f"Checking if key {key} exists, it {"does" if key in self.CACHE else "does not"}")
-                        response = encode_resp(1 if key in self.CACHE else 0)
-                    elif cmd_type == 'shutdown':
-                        logger.info("Shutting down server")
-                        self.shutdown()
-                        response = encode_resp('OK')
-
-                    elif cmd_type == 'unknown':
-                        logger.debug("Recieved unknown command")
-                        response = encode_resp(None)
-                    elif cmd_type == 'ignore':
-                        continue
-                    else:
+                    if client.killed:
+                        break
+                    # Skip empty reads and non-command payloads such as FULLRESYNC and the RDB file
+                    if not command or not isinstance(command, list):
                         continue
+                    try:
+                        for i in range(len(command)):
+                            if isinstance(command[i], bytes):
+                                command[i] = command[i].decode()
+                        logger.info(f"Received command: {command}")
+                        client.last_command = str(command[0]).lower()
+                        client.commands_processed += 1
+                        response = self.process_command(command, client)
+                    except Exception as e:
+                        # A failing command must not lose the replies of the rest of the batch
+                        logger.error(f"Error executing {command}: {e}")
+                        response = encode_error(f"ERR {e}") if connection is not self.master_socket else None
                     
                     if response:
-                        connection.sendall(response)
+                        client.add_reply(response)
+
+                # Write the replies of the whole read batch with a single syscall
+                self.flush_client(client)
         except ConnectionRefusedError:
             logger.error(f"Connection refused by {address}")
         except ConnectionResetError:
@@ -192,8 +279,402 @@ class RedisServer:
             logger.error(f"{self.role} Error occured handling: {e}")
 
         finally:
+            # Replies of commands that were already applied are still sent before closing
+            try:
+                self.flush_client(client)
+            except OSError:
+                pass
+            if client.watched:
+                with self.lock:
+                    self.unwatch(client)
+            if connection in self.REPLICAS:
+                self.drop_slave(client)
+            self.unregister_client(client)
             connection.close()
 
+    def flush_client(self, client):
+        '''Writes the buffered replies of a client. Replies to a slave go through its replication stream, the only writer of its socket.'''
+        if client.replication_queue is None:
+            client.flush()
+        elif client.output_buffer:
+            with self.lock:
+                self.queue_for_slave(client, b''.join(client.output_buffer))
+            client.output_buffer.clear()
+            client.output_size = 0
+
+    def parse_query_buffer(self, client):
+        '''Decodes every complete command in the query buffer of a client and removes them from it.'''
+
+        buffer = client.query_buffer
+        # A bulk string announced its length, there is nothing to decode until all of it arrived
+        if len(buffer) < client.query_needed:
+            return []
+
+        commands = []
+        pos = 0
+        while pos < len(buffer):
+            try:
+                if client.expecting_rdb and buffer.startswith(b'$', pos):
+                    command, pos = decode_rdb_at(buffer, pos)
+                    client.expecting_rdb = False
+                else:
+                    command, pos = decode_resp_at(buffer, pos)
+            except IncompleteRESPError as e:
+                client.query_needed = e.needed - pos if e.needed else 0
+                break
+
+            # Only the master sends the RDB file, right after the FULLRESYNC reply
+            if client.connection is self.master_socket and isinstance(command, str) and command.startswith("FULLRESYNC"):
+                client.expecting_rdb = True
+            commands.append(command)
+        else:
+            client.query_needed = 0
+
+        del buffer[:pos]
+        return commands
+
+    def process_command(self, command, client):
+        '''Handles the transaction commands and queues commands inside MULTI, everything else is executed under the keyspace lock.'''
+
+        cmd_type = command[0].lower() if type(command[0]) is str else command[0]
+        arity = COMMAND_ARITY.get(cmd_type)
+
+        if arity is not None and (len(command) != arity if arity > 0 else len(command) < -arity):
+            response = encode_error(f"ERR wrong number of arguments for '{cmd_type}' command")
+            # Like Redis a command rejected inside MULTI makes EXEC discard the transaction
+            if client.in_multi:
+                client.multi_error = True
+        elif cmd_type == 'multi':
+            if client.in_multi:
+                response = encode_error("ERR MULTI calls can not be nested")
+            else:
+                logger.debug(f"Starting transaction for {client.address}")
+                client.in_multi = True
+                response = encode_resp('OK')
+        elif cmd_type == 'exec':
+            if not client.in_multi:
+                response = encode_error("ERR EXEC without MULTI")
+            else:
+                response = self.exec_transaction(client)
+        elif cmd_type == 'discard':
+            if not client.in_multi:
+                response = encode_error("ERR DISCARD without MULTI")
+            else:
+                logger.debug(f"Discarding {len(client.queued)} queued commands for {client.address}")
+                client.reset_transaction()
+                with self.lock:
+                    self.unwatch(client)
+                response = encode_resp('OK')
+        elif cmd_type == 'watch':
+            if client.in_multi:
+                response = encode_error("ERR WATCH inside MULTI is not allowed")
+                client.multi_error = True
+            else:
+                with self.lock:
+                    self.watch(client, [str(key) for key in command[1:]])
+                logger.debug(f"Watching keys {list(client.watched)} for {client.address}")
+                response = encode_resp('OK')
+        elif cmd_type == 'unwatch' and not client.in_multi:
+            with self.lock:
+                self.unwatch(client)
+            response = encode_resp('OK')
+        elif client.in_multi and arity is None:
+            response = encode_error(f"ERR unknown command '{command[0]}'")
+            client.multi_error = True
+        elif client.in_multi:
+            logger.debug(f"Queueing {command} for {client.address}")
+            client.queued.append(command)
+            response = encode_resp('QUEUED')
+        elif cmd_type in LOCK_FREE_COMMANDS:
+            return self.execute_command(command, client)
+        else:
+            with self.lock:
+                return self.execute_command(command, client)
+
+        # Replicas never answer the replication stream
+        if client.connection is self.master_socket:
+            return None
+        return response
+
+    def exec_transaction(self, client):
+        '''Runs the queued commands of a transaction back-to-back under one keyspace lock and returns the aggregated reply.'''
+
+        with self.lock:
+            if client.multi_error:
+                logger.debug(f"Discarding transaction with queueing errors for {client.address}")
+                client.reset_transaction()
+                self.unwatch(client)
+                return encode_error("EXECABORT Transaction discarded because of previous errors.")
+
+            if any(self.VERSIONS[key] != version for key, version in client.watched.items()):
+                logger.debug(f"Watched keys changed, aborting transaction for {client.address}")
+                client.reset_transaction()
+                self.unwatch(client)
+                return b"*-1\r\n"
+
+            logger.debug(f"Executing {len(client.queued)} queued commands for {client.address}")
+            client.replication_backlog = []
+            responses = []
+            for command in client.queued:
+                try:
+                    responses.append(self.execute_command(command, client) or encode_resp(None))
+                except Exception as e:
+                    # A failing command does not roll back the others, same as Redis
+                    logger.error(f"Error executing {command} in transaction: {e}")
+                    responses.append(encode_error(f"ERR {e}"))
+            backlog = client.replication_backlog
+            client.reset_transaction()
+            self.unwatch(client)
+
+            if backlog:
+                self.propagate([["MULTI"], *backlog, ["EXEC"]])
+
+        return f"*{len(responses)}\r\n".encode() + b''.join(responses)
+
+    def execute_command(self, command, client):
+        '''Executes a single command and returns the encoded response. The caller must hold the keyspace lock unless the command is in LOCK_FREE_COMMANDS.'''
+
+        connection, address = client.connection, client.address
+        response = None
+        cmd_type = command[0].lower() if type(command[0]) is str else command[0]
+
+        if cmd_type == 'ping':
+            logger.debug("Sending PONG")
+            response = encode_resp('PONG')
+        elif cmd_type == 'echo':
+            logger.debug(f"Echoing back {command[1]}")
+            response = encode_resp(command[1].encode())
+        elif cmd_type == 'set':
+            key: str = str(command[1])
+            value: str = str(command[2])
+            logger.debug(f"Setting key {key} to value {value}")
+            self.CACHE[key] = value
+            self.touch(key)
+
+            if len(command) > 3 and command[3].lower() == 'px':
+                logger.debug(f"Setting TTL for key {key} to {command[4]} milliseconds")
+                self.TTL[key] = time.time() + int(command[4]) / 1000
+
+            if connection is not self.master_socket:
+                response = encode_resp('OK')
+
+            self.replicate(command, client)
+        elif cmd_type == 'del':
+            key: str = str(command[1])
+
+            if key in self.CACHE:
+                del self.CACHE[key]
+                self.touch(key)
+
+                if key in self.TTL:    
+                    del self.TTL[key]
+
+                response = encode_resp(1)
+                logger.debug(f"Deleting key {key}")
+
+                self.replicate(command, client)
+            else:
+                logger.debug(f"No key {key} to delete")
+                response = encode_resp(0)
+        elif cmd_type == 'get':
+            logger.debug(f"Getting key {command[1]}")
+            if command[1] in self.TTL and self.TTL[command[1]] < time.time():
+                del self.CACHE[command[1]]
+                del self.TTL[command[1]]
+                self.touch(command[1])
+            value = self.CACHE.get(command[1], None)
+            logger.debug(f"Value for key {command[1]} is {value}")
+            response = encode_resp(value.encode() if value is not None else None)
+        elif cmd_type == 'info':
+            logger.debug(f"Sending server info role:{self.role}, connected_slaves:{len(self.SLAVES)}, master_replid:{self.master_replid}, master_repl_offset:{self.master_repl_offset}")
+            response = encode_resp(f"role:{self.role}, connected_slaves:{len(self.SLAVES)}, master_replid:{self.master_replid}, master_repl_offset:{self.master_repl_offset}")
+        elif cmd_type == 'replconf':
+            if command[1].lower() == "listening-port":
+                logger.debug(f"Received REPLCONF listening-port {command[2]}")
+                response = encode_resp('OK')
+            elif command[1].lower() == "capa":
+                response = encode_resp('OK')
+            elif command[1].lower() == "getack":
+                logger.debug(f"Received ACK from slave {address}")
+                response = encode_resp(['REPLECONF','ACK',0])
+            else:
+                logger.debug(f"Received unknown REPLCONF command: {command}")
+                response = encode_resp('OK')
+        elif cmd_type == 'psync':
+            if command[1] == "?":
+                response = encode_resp(f"FULLRESYNC {self.master_replid} {self.master_repl_offset}")
+                rdb_hex = "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e3bfec0ff5aa2"
+                rdb_content = bytes.fromhex(rdb_hex)
+                length = len(rdb_content)
+                header = f"${length}\r\n".encode()
+                logger.debug("Sending RDP file to SLAVE")
+                response += header + rdb_content
+
+                # The sync payload is the start of the replication stream so it comes before every propagated write
+                if client.replication_queue is None:
+                    self.add_slave(client)
+                self.queue_for_slave(client, response)
+                response = None
+        elif cmd_type == 'fullresync':
+            logger.debug("Receiving RDB file from master")
+        elif cmd_type == 'exists':
+            key: str = str(command[1])
+            logger.debug(f"Checking if key {key} exists, it {"does" if key in self.CACHE else "does not"}")
+            response = encode_resp(1 if key in self.CACHE else 0)
+        elif cmd_type == 'unwatch':
+            # Only reached for an UNWATCH queued inside MULTI, EXEC already checked the watched keys
+            self.unwatch(client)
+            response = encode_resp('OK')
+        elif cmd_type == 'client':
+            response = self.client_command(command, client)
+        elif cmd_type == 'shutdown':
+            logger.info("Shutting down server")
+            self.shutdown()
+            response = encode_resp('OK')
+
+        elif cmd_type == 'unknown':
+            logger.debug("Recieved unknown command")
+            response = encode_resp(None)
+
+        return response
+
+    def client_command(self, command, client):
+        '''Handles the CLIENT LIST and CLIENT KILL subcommands.'''
+
+        subcommand = str(command[1]).lower() if len(command) > 1 else None
+        with self.clients_lock:
+            clients = list(self.CLIENTS.values())
+
+        if subcommand == 'list':
+            logger.debug(f"Listing {len(clients)} clients")
+            return encode_resp("".join(self.describe_client(other) + "\n" for other in clients).encode())
+        elif subcommand == 'kill' and len(command) == 3:
+            # Old style CLIENT KILL host:port
+            targets = [other for other in clients if other.addr == str(command[2])]
+            if not targets:
+                return encode_error("ERR No such client")
+            for target in targets:
+                logger.info(f"Killing client {target.addr}")
+                self.kill_client(target, current=client)
+            return encode_resp('OK')
+        elif subcommand == 'kill':
+            filters = command[2:]
+            if not filters or len(filters) % 2:
+                return encode_error("ERR syntax error")
+
+            # Like Redis the filter form never kills the calling client
+            targets = [other for other in clients if other is not client]
+            for name, value in zip(filters[::2], filters[1::2]):
+                name, value = str(name).lower(), str(value)
+                if name == 'id':
+                    targets = [other for other in targets if str(other.id) == value]
+                elif name == 'addr':
+                    targets = [other for other in targets if other.addr == value]
+                else:
+                    return encode_error("ERR syntax error")
+
+            for target in targets:
+                logger.info(f"Killing client {target.addr}")
+                self.kill_client(target, current=client)
+            return encode_resp(len(targets))
+
+        return encode_error(f"ERR unknown subcommand '{command[1] if len(command) > 1 else ''}'")
+
+    def describe_client(self, client):
+        '''Formats a client as a line of the CLIENT LIST reply.'''
+
+        now = time.time()
+        flags = "M" if client.connection is self.master_socket else "S" if client.connection in self.SLAVES else ""
+        flags += "x" if client.in_multi else ""
+        return (f"id={client.id} addr={client.addr} age={int(now - client.created_at)} idle={int(now - client.last_interaction)} "
+                f"flags={flags or 'N'} multi={len(client.queued) if client.in_multi else -1} qbuf={len(client.query_buffer)} oll={len(client.output_buffer)} "
+                f"omem={client.output_size + client.replication_queued - client.replication_sent} "
+                f"tot-net-in={client.bytes_in} tot-net-out={client.bytes_out + client.replication_sent} "
+                f"tot-cmds={client.commands_processed} cmd={client.last_command}")
+
+    def touch(self, key):
+        '''Bumps the version of a watched key so transactions watching it are aborted.'''
+        if key in self.VERSIONS:
+            self.VERSIONS[key] += 1
+
+    def watch(self, client, keys):
+        '''Records the current version of keys for a client. The caller must hold the keyspace lock.'''
+        for key in keys:
+            if key not in client.watched:
+                self.WATCHERS[key] = self.WATCHERS.get(key, 0) + 1
+                client.watched[key] = self.VERSIONS.setdefault(key, 0)
+
+    def unwatch(self, client):
+        '''Releases the watched keys of a client, forgetting the versions of keys nobody watches anymore. The caller must hold the keyspace lock.'''
+        for key in client.watched:
+            self.WATCHERS[key] -= 1
+            if not self.WATCHERS[key]:
+                del self.WATCHERS[key]
+                del self.VERSIONS[key]
+        client.watched.clear()
+
+    def replicate(self, command, client):
+        '''Propagates a write command to the slaves, or collects it while the client is executing a transaction.'''
+        if self.role != "master":
+            return
+
+        if client.replication_backlog is not None:
+            client.replication_backlog.append(command)
+        else:
+            self.propagate([command])
+
+    def propagate(self, commands):
+        '''Queues commands for every slave as a single payload so a slave never sees only part of them.
+
+        The caller holds the keyspace lock, which keeps the order of the writes. The payload is written
+        by the thread of each slave, so a slave that stops reading never blocks the lock.
+        '''
+        payload = b''.join(encode_resp(command) for command in commands)
+        for replica in list(self.REPLICAS.values()):
+            if replica.replication_queued - replica.replication_sent + len(payload) > self.replica_output_buffer_limit:
+                logger.warning(f"Dropping slave {replica.addr}, output buffer limit reached")
+                self.drop_slave(replica)
+                self.kill_client(replica)
+                continue
+
+            logger.debug(f"Queueing {commands} for slave at {replica.addr}")
+            self.queue_for_slave(replica, payload)
+
+    def queue_for_slave(self, client, payload):
+        '''Appends a payload to the replication stream of a slave. The caller must hold the keyspace lock.'''
+        client.replication_queued += len(payload)
+        client.replication_queue.put(payload)
+
+    def add_slave(self, client):
+        '''Registers a connection as a slave and starts the thread writing its replication stream. The caller must hold the keyspace lock.'''
+        logger.debug(f"Adding slave {client.addr}")
+        client.replication_queue = queue.Queue()
+        self.SLAVES.append(client.connection)
+        self.REPLICAS[client.connection] = client
+        threading.Thread(target=self.feed_slave, args=(client,), daemon=True).start()
+
+    def drop_slave(self, client):
+        '''Stops replicating to a slave and ends the thread writing its replication stream.'''
+        with self.lock:
+            if self.REPLICAS.pop(client.connection, None) is None:
+                return
+            self.SLAVES.remove(client.connection)
+        client.replication_queue.put(None)
+
+    def feed_slave(self, client):
+        '''Writes the queued replication stream of a slave until it is dropped.'''
+        try:
+            while True:
+                payload = client.replication_queue.get()
+                if payload is None:
+                    break
+                client.connection.sendall(payload)
+                client.replication_sent += len(payload)
+        except OSError as e:
+            logger.error(f"Error sending to slave: {e}")
+            self.drop_slave(client)
+            self.kill_client(client)
+
     def handshake(self):
         '''Performs the initial handshake with the master server to establish replication.'''
     
@@ -201,6 +682,7 @@ class RedisServer:
             try:
                 logger.info(f"Connecting to master at {self.master_host}:{self.master_port}")
                 self.master_socket = master_socket = socket.create_connection((self.master_host, self.master_port))
+                self.configure_socket(master_socket)
                 logger.info("Sending PING to master")
                 master_socket.sendall(encode_resp(["PING"]))
                 response, _ = decode_resp(master_socket.recv(4096))
@@ -229,13 +711,18 @@ def main():
     parser = argparse.ArgumentParser(description="Simple Redis server")
     parser.add_argument('--port', type=int, default=6379, help='Port number to use')
     parser.add_argument('--replicaof', type=str, help='Master host and port number to use for slave')
+    parser.add_argument('--maxclients', type=int, default=10000, help='Maximum number of connected clients')
+    parser.add_argument('--timeout', type=int, default=0, help='Close connections idle for this many seconds, 0 to disable')
+    parser.add_argument('--tcp-nodelay', action=argparse.BooleanOptionalAction, default=True, help='Set TCP_NODELAY on client sockets')
+    parser.add_argument('--tcp-keepalive', type=int, default=300, help='TCP keepalive interval in seconds, 0 to disable')
     args = parser.parse_args()
 
+    options = dict(PORT=args.port, maxclients=args.maxclients, timeout=args.timeout, tcp_nodelay=args.tcp_nodelay, tcp_keepalive=args.tcp_keepalive)
     if args.replicaof is None:
-        server = RedisServer(PORT=args.port, role="master")
+        server = RedisServer(role="master", **options)
     else:
         master_host, master_port = args.replicaof.split()
-        server = RedisServer(PORT=args.port, role="slave", master_host=master_host, master_port=int(master_port))
+        server = RedisServer(role="slave", master_host=master_host, master_port=int(master_port), **options)
 
     server.start_server()
     # Close all slave connections
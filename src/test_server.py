@@ -38,6 +38,11 @@ class TestRedisServer(unittest.TestCase):
         response = client_socket.recv(4096)
         client_socket.close()
         return response
+
+    def exchange(self, client_socket, command):
+        '''Send a command over an open connection and return the response'''
+        client_socket.sendall(command)
+        return client_socket.recv(4096)
     
 
 
@@ -118,6 +123,21 @@ class TestRedisServer(unittest.TestCase):
             response = self.send_command(f"*2\r\n$3\r\nGET\r\n${len(key)}\r\n{key}\r\n".encode())
             self.assertEqual(response, f"${len(value)}\r\n{value}\r\n".encode())
 
+    @tag('pipeline')
+    def test_pipeline_with_failing_command(self):
+        '''Test that a failing command gets an error reply and does not stop the rest of the pipeline'''
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            client_socket.sendall(b"*1\r\n$4\r\nPING\r\n*2\r\n$3\r\nGET\r\n$1\r\n\xff\r\n*1\r\n$4\r\nPING\r\n")
+            response = b""
+            while response.count(b"\r\n") < 3:
+                data = client_socket.recv(4096)
+                if not data:
+                    break
+                response += data
+
+        self.assertTrue(response.startswith(b"+PONG\r\n-ERR "))
+        self.assertTrue(response.endswith(b"\r\n+PONG\r\n"))
+
     @tag('unknown')
     def test_unknown_command(self):
         '''Test an unknown command'''
@@ -147,6 +167,8 @@ class TestRedisServer(unittest.TestCase):
         # Set a key on the master
         self.send_command(b"*3\r\n$3\r\nSET\r\n$4\r\nkey1\r\n$5\r\nvalue\r\n")
 
+        time.sleep(0.1)  # Wait for the slave to apply the write
+
         # Check if the key is replicated to the slave
         response = self.send_command(b"*2\r\n$3\r\nGET\r\n$4\r\nkey1\r\n", host="localhost", port=slave_server.PORT)
         self.assertEqual(response, b"$5\r\nvalue\r\n")
@@ -154,6 +176,312 @@ class TestRedisServer(unittest.TestCase):
         slave_server.shutdown()
         slave_thread.join()
 
+    @tag('transaction')
+    def test_multi_exec(self):
+        '''Test queueing commands with MULTI and running them with EXEC'''
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$5\r\nMULTI\r\n"), b"+OK\r\n")
+            response = self.exchange(client_socket, b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbar\r\n")
+            self.assertEqual(response, b"+QUEUED\r\n")
+            response = self.exchange(client_socket, b"*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n")
+            self.assertEqual(response, b"+QUEUED\r\n")
+
+            # Nothing is executed before EXEC
+            self.assertEqual(self.send_command(b"*2\r\n$6\r\nEXISTS\r\n$3\r\nfoo\r\n"), b":0\r\n")
+
+            response = self.exchange(client_socket, b"*1\r\n$4\r\nEXEC\r\n")
+            self.assertEqual(response, b"*2\r\n+OK\r\n$3\r\nbar\r\n")
+
+    @tag('transaction')
+    def test_multi_exec_pipelined(self):
+        '''Test a whole transaction sent in a single write'''
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            client_socket.sendall(
+                b"*1\r\n$5\r\nMULTI\r\n"
+                b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbar\r\n"
+                b"*1\r\n$4\r\nEXEC\r\n"
+            )
+            expected = b"+OK\r\n+QUEUED\r\n*1\r\n+OK\r\n"
+            response = b""
+            while len(response) < len(expected):
+                response += client_socket.recv(4096)
+            self.assertEqual(response, expected)
+
+        self.assertEqual(self.send_command(b"*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n"), b"$3\r\nbar\r\n")
+
+    @tag('transaction')
+    def test_discard(self):
+        '''Test dropping a queued transaction with DISCARD'''
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.exchange(client_socket, b"*1\r\n$5\r\nMULTI\r\n")
+            self.exchange(client_socket, b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbar\r\n")
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$7\r\nDISCARD\r\n"), b"+OK\r\n")
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$4\r\nEXEC\r\n"), b"-ERR EXEC without MULTI\r\n")
+
+        self.assertEqual(self.send_command(b"*2\r\n$6\r\nEXISTS\r\n$3\r\nfoo\r\n"), b":0\r\n")
+
+    @tag('transaction')
+    def test_watch(self):
+        '''Test that EXEC is aborted when a watched key changes'''
+        self.send_command(b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbar\r\n")
+
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.assertEqual(self.exchange(client_socket, b"*2\r\n$5\r\nWATCH\r\n$3\r\nfoo\r\n"), b"+OK\r\n")
+            self.send_command(b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbaz\r\n")
+            self.exchange(client_socket, b"*1\r\n$5\r\nMULTI\r\n")
+            self.exchange(client_socket, b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nqux\r\n")
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$4\r\nEXEC\r\n"), b"*-1\r\n")
+
+            # The watch is cleared by EXEC, so the next transaction goes through
+            self.exchange(client_socket, b"*1\r\n$5\r\nMULTI\r\n")
+            self.exchange(client_socket, b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nqux\r\n")
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$4\r\nEXEC\r\n"), b"*1\r\n+OK\r\n")
+
+        self.assertEqual(self.send_command(b"*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n"), b"$3\r\nqux\r\n")
+
+    @tag('transaction')
+    def test_exec_abort(self):
+        '''Test that EXEC discards a transaction after a command was rejected while queueing'''
+        rejected = [
+            (b"*2\r\n$3\r\nSET\r\n$1\r\na\r\n", b"-ERR wrong number of arguments for 'set' command\r\n"),
+            (b"*1\r\n$3\r\nFOO\r\n", b"-ERR unknown command 'FOO'\r\n"),
+            (b"*2\r\n$5\r\nWATCH\r\n$1\r\nb\r\n", b"-ERR WATCH inside MULTI is not allowed\r\n"),
+        ]
+        for command, error in rejected:
+            with socket.create_connection(("localhost", 6380)) as client_socket:
+                self.exchange(client_socket, b"*1\r\n$5\r\nMULTI\r\n")
+                self.assertEqual(self.exchange(client_socket, command), error)
+                response = self.exchange(client_socket, b"*3\r\n$3\r\nSET\r\n$1\r\nb\r\n$1\r\n1\r\n")
+                self.assertEqual(response, b"+QUEUED\r\n")
+                response = self.exchange(client_socket, b"*1\r\n$4\r\nEXEC\r\n")
+                self.assertEqual(response, b"-EXECABORT Transaction discarded because of previous errors.\r\n")
+
+            self.assertEqual(self.send_command(b"*2\r\n$6\r\nEXISTS\r\n$1\r\nb\r\n"), b":0\r\n")
+
+    @tag('transaction')
+    def test_watch_without_keys(self):
+        '''Test that WATCH needs at least one key'''
+        response = self.send_command(b"*1\r\n$5\r\nWATCH\r\n")
+        self.assertEqual(response, b"-ERR wrong number of arguments for 'watch' command\r\n")
+
+    @tag('setget')
+    def test_set_wrong_number_of_arguments(self):
+        '''Test that SET without a value is rejected'''
+        response = self.send_command(b"*2\r\n$3\r\nSET\r\n$1\r\na\r\n")
+        self.assertEqual(response, b"-ERR wrong number of arguments for 'set' command\r\n")
+
+    @tag('transaction')
+    def test_watch_versions_released(self):
+        '''Test that key versions are only kept while a client watches the key'''
+        for i in range(10):
+            self.send_command(f"*3\r\n$3\r\nSET\r\n$4\r\nkey{i}\r\n$5\r\nvalue\r\n".encode())
+            self.send_command(f"*2\r\n$3\r\nDEL\r\n$4\r\nkey{i}\r\n".encode())
+        self.assertEqual(self.server.VERSIONS, {})
+
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.exchange(client_socket, b"*2\r\n$5\r\nWATCH\r\n$3\r\nfoo\r\n")
+            self.assertEqual(self.server.WATCHERS, {"foo": 1})
+
+        time.sleep(0.1)  # Wait for the server to notice the closed connection
+        self.assertEqual(self.server.VERSIONS, {})
+        self.assertEqual(self.server.WATCHERS, {})
+
+    @tag('transaction')
+    def test_unwatch_inside_multi(self):
+        '''Test that UNWATCH inside MULTI is queued and does not release the watched keys'''
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.exchange(client_socket, b"*2\r\n$5\r\nWATCH\r\n$3\r\nfoo\r\n")
+            self.exchange(client_socket, b"*1\r\n$5\r\nMULTI\r\n")
+            self.exchange(client_socket, b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbar\r\n")
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$7\r\nUNWATCH\r\n"), b"+QUEUED\r\n")
+            self.send_command(b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbaz\r\n")
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$4\r\nEXEC\r\n"), b"*-1\r\n")
+
+        self.assertEqual(self.send_command(b"*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n"), b"$3\r\nbaz\r\n")
+
+    @tag('transaction', 'propagation')
+    def test_transaction_propagation(self):
+        '''Test that a transaction is propagated to a slave server'''
+        slave_server = RedisServer(PORT=8000, role="slave", master_host="localhost", master_port=self.server.PORT)
+        slave_thread = threading.Thread(target=slave_server.start_server)
+        slave_thread.start()
+
+        # Wait for servers to start
+        time.sleep(0.1)
+
+        self.send_command(b"*3\r\n$3\r\nSET\r\n$4\r\nkey3\r\n$5\r\nvalue\r\n")
+        time.sleep(0.1)  # Wait for the slave to apply the write
+        response = self.send_command(b"*2\r\n$6\r\nEXISTS\r\n$4\r\nkey3\r\n", host="localhost", port=slave_server.PORT)
+        self.assertEqual(response, b":1\r\n")
+
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.exchange(client_socket, b"*1\r\n$5\r\nMULTI\r\n")
+            self.exchange(client_socket, b"*3\r\n$3\r\nSET\r\n$4\r\nkey1\r\n$5\r\nvalue\r\n")
+            self.exchange(client_socket, b"*3\r\n$3\r\nSET\r\n$4\r\nkey2\r\n$5\r\nvalue\r\n")
+            self.exchange(client_socket, b"*2\r\n$3\r\nDEL\r\n$4\r\nkey3\r\n")
+            self.exchange(client_socket, b"*1\r\n$4\r\nEXEC\r\n")
+
+        time.sleep(0.1)  # Wait for the slave to apply the transaction
+
+        for key in (b"key1", b"key2"):
+            response = self.send_command(b"*2\r\n$3\r\nGET\r\n$4\r\n" + key + b"\r\n", host="localhost", port=slave_server.PORT)
+            self.assertEqual(response, b"$5\r\nvalue\r\n")
+        response = self.send_command(b"*2\r\n$6\r\nEXISTS\r\n$4\r\nkey3\r\n", host="localhost", port=slave_server.PORT)
+        self.assertEqual(response, b":0\r\n")
+
+        slave_server.shutdown()
+        slave_thread.join()
+
+    def connect_stalled_slave(self):
+        '''Open a connection that registers as a slave and then never reads'''
+        slave_socket = socket.socket()
+        slave_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slave_socket.connect(("localhost", 6380))
+        self.exchange(slave_socket, b"*3\r\n$8\r\nREPLCONF\r\n$14\r\nlistening-port\r\n$4\r\n9999\r\n")
+        slave_socket.sendall(b"*3\r\n$5\r\nPSYNC\r\n$1\r\n?\r\n$2\r\n-1\r\n")
+        time.sleep(0.1)  # Wait for the master to register the slave
+        return slave_socket
+
+    def write_large_values(self, count):
+        '''Set count keys to 100 KB values'''
+        value = b"x" * (100 * 1024)
+        for i in range(count):
+            key = f"key{i:03}".encode()
+            response = self.send_command(b"*3\r\n$3\r\nSET\r\n$6\r\n%s\r\n$%d\r\n%s\r\n" % (key, len(value), value))
+            self.assertEqual(response, b"+OK\r\n")
+
+    @tag('propagation')
+    def test_stalled_slave(self):
+        '''Test that a slave which stops reading does not block the master'''
+        with self.connect_stalled_slave() as slave_socket:
+            self.write_large_values(100)
+
+            with socket.create_connection(("localhost", 6380), timeout=3) as client_socket:
+                self.assertEqual(self.exchange(client_socket, b"*1\r\n$4\r\nPING\r\n"), b"+PONG\r\n")
+
+                addr = "{}:{}".format(*slave_socket.getsockname())
+                command = f"*4\r\n$6\r\nCLIENT\r\n$4\r\nKILL\r\n$4\r\nADDR\r\n${len(addr)}\r\n{addr}\r\n".encode()
+                self.assertEqual(self.exchange(client_socket, command), b":1\r\n")
+
+            time.sleep(0.1)  # Wait for the master to drop the slave
+            self.assertIn(b"connected_slaves:0", self.send_command(b"*1\r\n$4\r\nINFO\r\n"))
+
+    @tag('propagation')
+    def test_slave_output_buffer_limit(self):
+        '''Test that a slave is dropped once its replication stream exceeds the output buffer limit'''
+        self.server.replica_output_buffer_limit = 1024 * 1024
+
+        with self.connect_stalled_slave():
+            self.assertIn(b"connected_slaves:1", self.send_command(b"*1\r\n$4\r\nINFO\r\n"))
+            self.write_large_values(100)
+            self.assertIn(b"connected_slaves:0", self.send_command(b"*1\r\n$4\r\nINFO\r\n"))
+
+    @tag('pipeline')
+    def test_pipeline(self):
+        '''Test that all replies of a pipeline are returned'''
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            client_socket.sendall(b"*1\r\n$4\r\nPING\r\n" * 1000)
+            expected = b"+PONG\r\n" * 1000
+            response = b""
+            while len(response) < len(expected):
+                response += client_socket.recv(4096)
+            self.assertEqual(response, expected)
+
+    @tag('pipeline')
+    def test_pipeline_large_values(self):
+        '''Test a pipeline whose replies are large enough to be written with scatter-gather'''
+        value = "x" * 10000
+        self.send_command(f"*3\r\n$3\r\nSET\r\n$3\r\nbig\r\n${len(value)}\r\n{value}\r\n".encode())
+
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            client_socket.sendall(b"*2\r\n$3\r\nGET\r\n$3\r\nbig\r\n" * 5)
+            expected = f"${len(value)}\r\n{value}\r\n".encode() * 5
+            response = b""
+            while len(response) < len(expected):
+                response += client_socket.recv(65536)
+            self.assertEqual(response, expected)
+
+    @tag('setget')
+    def test_set_split_before_delimiter(self):
+        '''Test a value starting with REDIS whose trailing delimiter arrives in a later read'''
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            client_socket.sendall(b"*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$7\r\nREDISxx")
+            time.sleep(0.1)
+            self.assertEqual(self.exchange(client_socket, b"\r\n"), b"+OK\r\n")
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$4\r\nPING\r\n"), b"+PONG\r\n")
+
+        self.assertEqual(self.send_command(b"*2\r\n$3\r\nGET\r\n$1\r\nk\r\n"), b"$7\r\nREDISxx\r\n")
+
+    @tag('setget')
+    def test_set_get_large_value(self):
+        '''Test a value that spans many reads'''
+        value = b"x" * (4 * 1024 * 1024)
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            response = self.exchange(client_socket, b"*3\r\n$3\r\nSET\r\n$3\r\nbig\r\n$%d\r\n%s\r\n" % (len(value), value))
+            self.assertEqual(response, b"+OK\r\n")
+
+            client_socket.sendall(b"*2\r\n$3\r\nGET\r\n$3\r\nbig\r\n")
+            expected = b"$%d\r\n%s\r\n" % (len(value), value)
+            response = bytearray()
+            while len(response) < len(expected):
+                response += client_socket.recv(1024 * 1024)
+            self.assertEqual(response, expected)
+
+    @tag('client')
+    def test_query_buffer_limit(self):
+        '''Test that a client announcing a bulk string over the query buffer limit is disconnected'''
+        self.server.client_query_buffer_limit = 1024
+
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            client_socket.sendall(b"*3\r\n$3\r\nSET\r\n$3\r\nbig\r\n$4096\r\n")
+            client_socket.settimeout(5)
+            self.assertEqual(client_socket.recv(4096), b"")
+
+    @tag('client')
+    def test_client_list(self):
+        '''Test the CLIENT LIST command'''
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.exchange(client_socket, b"*1\r\n$4\r\nPING\r\n")
+            response = self.exchange(client_socket, b"*2\r\n$6\r\nCLIENT\r\n$4\r\nLIST\r\n")
+            host, port = client_socket.getsockname()
+
+        self.assertIn(f"addr={host}:{port}".encode(), response)
+        self.assertIn(b"tot-net-in=40 tot-net-out=7 tot-cmds=2 cmd=client", response)
+
+    @tag('client')
+    def test_client_kill(self):
+        '''Test closing another connection with CLIENT KILL'''
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.exchange(client_socket, b"*1\r\n$4\r\nPING\r\n")
+            addr = "{}:{}".format(*client_socket.getsockname())
+
+            response = self.send_command(f"*4\r\n$6\r\nCLIENT\r\n$4\r\nKILL\r\n$4\r\nADDR\r\n${len(addr)}\r\n{addr}\r\n".encode())
+            self.assertEqual(response, b":1\r\n")
+            self.assertEqual(client_socket.recv(4096), b"")
+
+        response = self.send_command(b"*3\r\n$6\r\nCLIENT\r\n$4\r\nKILL\r\n$11\r\nlocalhost:1\r\n")
+        self.assertEqual(response, b"-ERR No such client\r\n")
+
+    @tag('client')
+    def test_maxclients(self):
+        '''Test that connections over the maxclients limit are rejected'''
+        self.server.maxclients = 1
+
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$4\r\nPING\r\n"), b"+PONG\r\n")
+            response = self.send_command(b"*1\r\n$4\r\nPING\r\n")
+            self.assertEqual(response, b"-ERR max number of clients reached\r\n")
+
+    @tag('client')
+    def test_timeout(self):
+        '''Test that idle connections are closed after the timeout'''
+        self.server.timeout = 1
+
+        with socket.create_connection(("localhost", 6380)) as client_socket:
+            self.assertEqual(self.exchange(client_socket, b"*1\r\n$4\r\nPING\r\n"), b"+PONG\r\n")
+            client_socket.settimeout(5)
+            self.assertEqual(client_socket.recv(4096), b"")
+
     @tag('shutdown')
     def test_shutdown(self):
         '''Test the SHUTDOWN command'''
@@ -1,4 +1,21 @@
 DELIMITER = b"\r\n"
+IOV_MAX = 1024
+
+class IncompleteRESPError(ValueError):
+    '''Raised when the data ends before a complete RESP value was received.'''
+
+    def __init__(self, message, needed=None):
+        super().__init__(message)
+        # Length the data has to reach before decoding can succeed, if it is known
+        self.needed = needed
+
+def find_delimiter(data, start=0):
+    '''Returns the index of the next delimiter, raising IncompleteRESPError if it was not received yet.'''
+
+    index = data.find(DELIMITER, start)
+    if index == -1:
+        raise IncompleteRESPError("Missing delimiter")
+    return index
 
 def encode_resp(data):
     '''Encodes data into the Redis Serialization Protocol (RESP) format.'''
@@ -17,50 +34,90 @@ def encode_resp(data):
     else:
         raise TypeError(f"Unknown type: {type(data)}")
 
+def encode_error(message):
+    '''Encodes an error message into the Redis Serialization Protocol (RESP) format.'''
+
+    return f"-{message}\r\n".encode()
+
 def decode_resp(data):
     '''Decodes data from the Redis Serialization Protocol (RESP) format.'''
 
     if data == b'':
         return None, data
 
-    prefix = data[0:1]
+    value, end = decode_resp_at(data)
+    return value, data[end:]
+
+def decode_resp_at(data, pos=0):
+    '''Decodes the RESP value starting at pos and returns it with the position right after it.'''
+
+    if pos >= len(data):
+        raise IncompleteRESPError("No data", pos + 1)
+
+    prefix = data[pos:pos + 1]
 
     if prefix == b'+':  # Simple string
-        end_index = data.find(DELIMITER)
-        return data[1:end_index].decode(), data[end_index + 2:]
+        end_index = find_delimiter(data, pos)
+        return data[pos + 1:end_index].decode(), end_index + 2
     
     elif prefix == b'-':  # Error message
-        end_index = data.find(DELIMITER)
-        return data[1:end_index].decode(), data[end_index + 2:]
+        end_index = find_delimiter(data, pos)
+        return data[pos + 1:end_index].decode(), end_index + 2
 
     elif prefix == b':':  # Integer
-        end_index = data.find(DELIMITER)
-        return int(data[1:end_index]), data[end_index + 2:]
+        end_index = find_delimiter(data, pos)
+        return int(data[pos + 1:end_index]), end_index + 2
 
     elif prefix == b'$':  # Bulk string
-        length_end_index = data.find(DELIMITER)
-        length = int(data[1:length_end_index])
+        length_end_index = find_delimiter(data, pos)
+        length = int(data[pos + 1:length_end_index])
         if length == -1:
-            return None, data[length_end_index + 2:]
+            return None, length_end_index + 2
         start = length_end_index + 2
         end = start + length
-        return data[start:end], data[end + 2:]
+        if len(data) < end + 2:
+            raise IncompleteRESPError("Bulk string is not complete", end + 2)
+        return bytes(data[start:end]), end + 2
 
     elif prefix == b'*':  # Array
-        length_end_index = data.find(DELIMITER)
-        length = int(data[1:length_end_index])
+        length_end_index = find_delimiter(data, pos)
+        length = int(data[pos + 1:length_end_index])
         elements = []
-        rest = data[length_end_index + 2:]
+        pos = length_end_index + 2
         for _ in range(length):
-            element, rest = decode_resp(rest)
+            element, pos = decode_resp_at(data, pos)
             elements.append(element)
-        return elements, rest
-
-    elif data.startswith(b'REDIS'): # ignore RBB Files
-        return b'IGNORE', None
+        return elements, pos
 
     else:
-        raise ValueError(f"Unknown RESP type: {data[:1]}")
+        raise ValueError(f"Unknown RESP type: {data[pos:pos + 1]}")
+
+def decode_rdb_at(data, pos=0):
+    '''Decodes the RDB file a master sends after FULLRESYNC, a bulk string without the trailing delimiter.'''
+
+    length_end_index = find_delimiter(data, pos)
+    start = length_end_index + 2
+    end = start + int(data[pos + 1:length_end_index])
+    if len(data) < end:
+        raise IncompleteRESPError("RDB file is not complete", end)
+    return bytes(data[start:end]), end
+
+def sendmsg_all(sock, buffers):
+    '''Writes a list of buffers with scatter-gather sendmsg calls until all of them are sent.'''
+
+    views = [memoryview(buffer) for buffer in buffers if buffer]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX])
+        # Skip the fully written buffers and keep the unsent tail of a partial one
+        while sent:
+            size = len(views[index])
+            if sent >= size:
+                sent -= size
+                index += 1
+            else:
+                views[index] = views[index][sent:]
+                sent = 0
 
 def identify_running_threads():
     '''Identifies and prints the names of all running threads.'''